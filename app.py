@@ -1,6 +1,7 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
-import os, sys, re, unicodedata
+import functools, hashlib, io, os, sys, re, unicodedata
 
 # fallback per streamlit-javascript (detect mobile)
 try:
@@ -9,6 +10,13 @@ except Exception:
     def st_javascript(_code: str):
         return None
 
+# download con `data` callable (generato al click) solo sulle versioni di Streamlit che lo supportano
+try:
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    _DEFERRED_DOWNLOAD = hasattr(MediaFileManager, "add_deferred")
+except Exception:
+    _DEFERRED_DOWNLOAD = False
+
 # ---------------- CONFIGURAZIONE ----------------
 st.set_page_config(page_title="Ricerca Ricambi", layout="wide")
 
@@ -18,25 +26,94 @@ def get_path(filename: str) -> str:
         return os.path.join(sys._MEIPASS, filename)
     return os.path.join(os.path.abspath("."), filename)
 
+# Lettere accentate Latin-1 (minuscole) -> lettera base, come farebbe NFKD + rimozione diacritici
+_ACCENT_MAP = str.maketrans("àáâãäåçèéêëìíîïñòóôõöùúûüýÿ", "aaaaaaceeeeiiiinooooouuuuyy")
+
 def _normalize_text(x: str) -> str:
     if pd.isna(x):
         return ""
-    x = str(x).strip().lower()
+    x = str(x).strip().lower().translate(_ACCENT_MAP)
+    if x.isascii():
+        return x
+    # Caratteri fuori tabella: percorso generico NFKD
     x = unicodedata.normalize("NFKD", x)
     x = "".join(c for c in x if not unicodedata.combining(c))
     return x
 
+@st.cache_resource(show_spinner=False)
+def _combining_pattern() -> str:
+    # Classe regex con esattamente i caratteri che _normalize_text scarta (unicodedata.combining),
+    # compattata in intervalli di code point consecutivi
+    ranges = []
+    for i in range(sys.maxunicode + 1):
+        if unicodedata.combining(chr(i)):
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+    return "[" + "".join(chr(a) if a == b else f"{chr(a)}-{chr(b)}" for a, b in ranges) + "]"
+
+def _normalize_series(s: pd.Series) -> pd.Series:
+    # Versione vettoriale di _normalize_text per le colonne (quella scalare resta per le query).
+    # Toglie solo i diacritici combinanti: encode("ascii", "ignore") perderebbe anche °, µ, ”...
+    return (
+        s.str.strip()
+        .str.lower()
+        .str.normalize("NFKD")
+        .str.replace(_combining_pattern(), "", regex=True)
+    )
+
+EXCEL_FILE = "Ubicazione ricambi.xlsx"
+REQUIRED_COLS = ["Codice", "Descrizione", "Ubicazione", "Categoria"]
+
+def _prepare_data(df: pd.DataFrame) -> pd.DataFrame:
+    # Pulizia colonne
+    df.columns = df.columns.str.strip().str.title()
+    # Evita "nan" in output: rimpiazza NaN con stringa vuota PRIMA della normalizzazione
+    df = df.fillna("")
+    # Colonne normalizzate (calcolate una sola volta, non ad ogni rerun)
+    for col in REQUIRED_COLS:
+        if col in df.columns:
+            df[f"{col}_norm"] = _normalize_series(df[col].astype(str))
+    # Codice/Descrizione/Ubicazione: stringhe Arrow -> str.contains usa il kernel C++ di pyarrow
+    for col in ["Codice_norm", "Descrizione_norm", "Ubicazione_norm"]:
+        if col in df.columns:
+            df[col] = df[col].astype("string[pyarrow]")
+    # Categoria: poche modalità ripetute -> dtype category (filtro per codice intero)
+    if "Categoria_norm" in df.columns:
+        df["Categoria_norm"] = df["Categoria_norm"].astype("category")
+    return df
+
+def _read_excel(source) -> pd.DataFrame:
+    # calamine (Rust) è molto più veloce di openpyxl; fallback se non disponibile
+    try:
+        return pd.read_excel(source, engine="calamine")
+    except ImportError:
+        return pd.read_excel(source)
+
+def _file_signature(path: str):
+    # mtime + dimensione: chiave della cache, cambia quando il file viene aggiornato
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
 @st.cache_data(show_spinner=False)
-def load_data() -> pd.DataFrame:
+def load_data(signature) -> pd.DataFrame:
     try:
-        excel_path = get_path("Ubicazione ricambi.xlsx")
-        if os.path.exists(excel_path):
-            return pd.read_excel(excel_path)
+        excel_path = get_path(EXCEL_FILE)
+        if signature is not None and os.path.exists(excel_path):
+            return _prepare_data(_read_excel(excel_path))
         return pd.DataFrame()
     except Exception as e:
         st.error(f"Errore caricamento dati: {e}")
         return pd.DataFrame()
 
+@st.cache_data(show_spinner=False)
+def load_uploaded(data: bytes) -> pd.DataFrame:
+    return _prepare_data(_read_excel(io.BytesIO(data)))
+
 # ---------------- CSS ----------------
 st.markdown("""
     <style>
@@ -66,14 +143,17 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ---------------- CARICA DATI ----------------
-df = load_data()
+data_key = _file_signature(get_path(EXCEL_FILE))  # versione del dataset (chiave cache filtri)
+df = load_data(data_key)
 
 # Fallback: uploader se non trovato
 if df.empty:
     up = st.file_uploader("Carica 'Ubicazione ricambi.xlsx'", type=["xlsx"])
     if up is not None:
         try:
-            df = pd.read_excel(up)
+            data = up.getvalue()
+            df = load_uploaded(data)
+            data_key = hashlib.md5(data).hexdigest()
         except Exception as e:
             st.error(f"Errore lettura file caricato: {e}")
             st.stop()
@@ -82,22 +162,12 @@ if df.empty:
     st.error("Nessun dato disponibile.")
     st.stop()
 
-# Pulizia colonne + requisiti
-df.columns = df.columns.str.strip().str.title()
-
-# Evita "nan" in output: rimpiazza NaN con stringa vuota PRIMA della normalizzazione
-df = df.fillna("")
-
-required_cols = {"Codice", "Descrizione", "Ubicazione", "Categoria"}
-missing = required_cols - set(df.columns)
+# Requisiti
+missing = set(REQUIRED_COLS) - set(df.columns)
 if missing:
     st.error(f"Mancano le colonne richieste: {', '.join(sorted(missing))}")
     st.stop()
 
-# Colonne normalizzate
-for col in required_cols:
-    df[f"{col}_norm"] = df[col].astype(str).map(_normalize_text)
-
 # ---------------- SESSION STATE ----------------
 defaults = {"codice": "", "descrizione": "", "ubicazione": "", "categoria": "Tutte"}
 for k, v in defaults.items():
@@ -130,8 +200,24 @@ def _active_filters_chips():
     return chips
 
 # ---------------- DETECT MOBILE ----------------
-screen_width = st_javascript("window.innerWidth")
-is_mobile = bool(screen_width is not None and screen_width < 768)
+# Stima immediata dallo User-Agent (nessun round-trip col browser); st_javascript viene
+# chiamato solo finché non restituisce la larghezza reale, poi resta in session_state
+def _detect_mobile_from_ua(user_agent: str) -> bool:
+    return bool(re.search(r"Mobi|iPhone|iPod", user_agent or ""))
+
+if "screen_width" not in st.session_state:
+    screen_width = st_javascript("window.innerWidth")
+    if screen_width:  # 0/None finché il browser non ha risposto
+        st.session_state["screen_width"] = screen_width
+
+if "screen_width" in st.session_state:
+    is_mobile = st.session_state["screen_width"] < 768
+else:
+    if "ua_mobile" not in st.session_state:
+        context = getattr(st, "context", None)
+        headers = getattr(context, "headers", None) or {}
+        st.session_state["ua_mobile"] = _detect_mobile_from_ua(headers.get("User-Agent", ""))
+    is_mobile = st.session_state["ua_mobile"]
 
 # ---------------- HEADER + POP-UP FILTRI (Descrizione prima di Ubicazione) ----------------
 left, right = st.columns([3, 1])
@@ -194,25 +280,83 @@ if chips:
 if st.session_state.get("filters_applied", False):
     st.session_state["filters_applied"] = False  # consume flag
 
-mask = pd.Series(True, index=df.index)
-
-if st.session_state.codice:
-    q = _normalize_text(st.session_state.codice)
-    mask &= df["Codice_norm"].str.contains(q, na=False, regex=False)
-
-if st.session_state.descrizione:
-    q = _normalize_text(st.session_state.descrizione)
-    mask &= df["Descrizione_norm"].str.contains(q, na=False, regex=False)
-
-if st.session_state.ubicazione:
-    q = _normalize_text(st.session_state.ubicazione)
-    mask &= df["Ubicazione_norm"].str.contains(q, na=False, regex=False)
+TEXT_FILTERS = {"codice": "Codice_norm", "descrizione": "Descrizione_norm", "ubicazione": "Ubicazione_norm"}
+
+@st.cache_resource(show_spinner=False)
+def filter_stats(_df: pd.DataFrame, data_key) -> dict:
+    # Stima delle righe attese per ogni filtro, calcolata una volta per dataset:
+    # colonne testuali -> righe per valore distinto, categoria -> conteggio esatto
+    # (cache_resource: sola lettura, nessuna copia ad ogni chiamata)
+    n = len(_df)
+    stats = {key: n / max(_df[col].nunique(), 1) for key, col in TEXT_FILTERS.items()}
+    stats["categoria"] = _df["Categoria_norm"].value_counts().to_dict()
+    return stats
+
+# Codice/Ubicazione sono stringhe corte: su array numpy a larghezza fissa np.char.find
+# evita l'overhead per chiamata di pandas/Arrow (Descrizione resta Arrow: troppo padding)
+BYTES_FILTERS = ["codice", "ubicazione"]
+
+@st.cache_resource(show_spinner=False)
+def filter_arrays(_df: pd.DataFrame, data_key) -> dict:
+    # cache_resource: gli array sono solo letti, evita di copiarli ad ogni rerun
+    return {
+        key: np.char.encode(_df[TEXT_FILTERS[key]].to_numpy(dtype=str), "utf-8")
+        for key in BYTES_FILTERS
+    }
 
-if st.session_state.categoria != "Tutte":
-    q = _normalize_text(st.session_state.categoria)
-    mask &= df["Categoria_norm"] == q
+def _apply_filter(df: pd.DataFrame, arrays: dict, positions: np.ndarray, key: str, q: str) -> np.ndarray:
+    if key == "categoria":
+        cat = df["Categoria_norm"].cat
+        code = cat.categories.get_indexer([q])[0]  # -1 se la categoria non esiste
+        return positions[cat.codes.to_numpy()[positions] == code]
+    if key in arrays:
+        return positions[np.char.find(arrays[key][positions], q.encode("utf-8")) >= 0]
+    hit = df[TEXT_FILTERS[key]].iloc[positions].str.contains(q, na=False, regex=False)
+    return positions[hit.to_numpy(dtype=bool)]
+
+def _scan_positions(df: pd.DataFrame, data_key, positions: np.ndarray, filters: dict) -> np.ndarray:
+    # Applica i filtri alle sole righe `positions`, dal più selettivo al meno selettivo:
+    # ogni passo lavora sulle righe sopravvissute ai precedenti
+    stats = filter_stats(df, data_key)
+    arrays = filter_arrays(df, data_key)
+    steps = [(stats[key], key, _normalize_text(filters[key])) for key in TEXT_FILTERS if filters[key]]
+    if filters["categoria"] != "Tutte":
+        q = _normalize_text(filters["categoria"])
+        steps.append((stats["categoria"].get(q, 0), "categoria", q))
+
+    for _, key, q in sorted(steps):
+        if len(positions) == 0:
+            break
+        positions = _apply_filter(df, arrays, positions, key, q)
+    return positions
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def filter_positions(_df: pd.DataFrame, data_key, codice: str, descrizione: str,
+                     ubicazione: str, categoria: str) -> np.ndarray:
+    # `_df` non viene hashato: la chiave della cache è data_key + valori dei filtri
+    filters = {"codice": codice, "descrizione": descrizione, "ubicazione": ubicazione, "categoria": categoria}
+    return _scan_positions(_df, data_key, np.arange(len(_df)), filters)
+
+def _refines(new: dict, old: dict) -> bool:
+    # True se i risultati di `new` sono un sottoinsieme di quelli di `old`:
+    # stessa categoria e ogni query testuale contiene la precedente (es. "cusc" -> "cuscinetto")
+    if new["categoria"] != old["categoria"]:
+        return False
+    return all(_normalize_text(old[key]) in _normalize_text(new[key])
+               for key in TEXT_FILTERS if old[key])
+
+filters = {k: st.session_state[k] for k in defaults}
+last = st.session_state.get("_last_filter")
+if last is not None and last["data_key"] == data_key and last["filters"] == filters:
+    positions = last["positions"]
+elif last is not None and last["data_key"] == data_key and _refines(filters, last["filters"]):
+    # ricerca incrementale: basta scansionare i risultati precedenti
+    positions = _scan_positions(df, data_key, last["positions"], filters)
+else:
+    positions = filter_positions(df, data_key, **filters)
+st.session_state["_last_filter"] = {"data_key": data_key, "filters": filters, "positions": positions}
 
-filtro = df[mask]
+filtro = df.iloc[positions]
 
 # ---------------- RISULTATI ----------------
 total = len(filtro)
@@ -222,33 +366,47 @@ download_cols = ["Codice", "Descrizione", "Ubicazione", "Categoria"]
 cols_out = [c for c in download_cols if c in filtro.columns]
 
 # download SOLO su desktop/tablet (non mobile)
+# il CSV viene generato solo al click, non ad ogni rerun (se Streamlit lo supporta)
 if total > 0 and not is_mobile and cols_out:
+    csv_data = functools.partial(filtro[cols_out].to_csv, index=False)
     st.download_button(
         "📥 Scarica risultati (CSV)",
-        filtro[cols_out].to_csv(index=False),
+        csv_data if _DEFERRED_DOWNLOAD else csv_data(),
         "risultati.csv",
         "text/csv",
     )
 
 # ---------------- VISUALIZZAZIONE ----------------
+CARD_TEMPLATE = """
+    <div class="card">
+        <h4>🔢 {code}</h4>
+        <p><span class="muted">📄 Descrizione:</span> {desc}</p>
+        <p><span class="muted">📍 Ubicazione:</span> {ubic}</p>
+        <p><span class="muted">🛠️ Categoria:</span> {cat}</p>
+    </div>
+"""
+MAX_CARDS = 200  # limita il DOM su mobile
+MAX_ROWS = 2000  # righe inviate alla tabella desktop (il CSV contiene comunque tutto)
+
+def _or_dash(v):
+    return "—" if str(v).strip() == "" else v
+
 if is_mobile:
-    for _, row in filtro.iterrows():
-        code_view = "—" if str(row["Codice"]).strip() == "" else row["Codice"]
-        desc_view = "—" if str(row["Descrizione"]).strip() == "" else row["Descrizione"]
-        ubic_view = "—" if str(row["Ubicazione"]).strip() == "" else row["Ubicazione"]
-        cat_view  = "—" if str(row["Categoria"]).strip() == "" else row["Categoria"]
-
-        st.markdown(f"""
-            <div class="card">
-                <h4>🔢 {code_view}</h4>
-                <p><span class="muted">📄 Descrizione:</span> {desc_view}</p>
-                <p><span class="muted">📍 Ubicazione:</span> {ubic_view}</p>
-                <p><span class="muted">🛠️ Categoria:</span> {cat_view}</p>
-            </div>
-        """, unsafe_allow_html=True)
+    # Un solo st.markdown per tutte le card (invece di uno per riga)
+    cards = [
+        CARD_TEMPLATE.format(code=_or_dash(r.Codice), desc=_or_dash(r.Descrizione),
+                             ubic=_or_dash(r.Ubicazione), cat=_or_dash(r.Categoria))
+        for r in filtro[download_cols].head(MAX_CARDS).itertuples(index=False)
+    ]
+    if cards:
+        st.markdown("".join(cards), unsafe_allow_html=True)
+    if total > MAX_CARDS:
+        st.caption(f"Mostrati i primi {MAX_CARDS} di {total} risultati: affina i filtri per vedere gli altri.")
 else:
-    display_df = filtro.copy()
+    display_df = filtro[cols_out].head(MAX_ROWS).copy()
     for col in ["Codice", "Descrizione", "Ubicazione", "Categoria"]:
         if col in display_df.columns:
-            display_df[col] = display_df[col].map(lambda v: "—" if str(v).strip() == "" else v)
-    st.dataframe(display_df[cols_out], use_container_width=True, height=480)
+            display_df[col] = display_df[col].map(_or_dash)
+    st.dataframe(display_df, use_container_width=True, height=480)
+    if total > MAX_ROWS:
+        st.caption(f"Mostrati i primi {MAX_ROWS} di {total} risultati: scarica il CSV per averli tutti.")